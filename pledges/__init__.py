@@ -0,0 +1 @@
+"""Pledge logic shared by the Flask app (app.py) and the RQ worker."""
@@ -0,0 +1,418 @@
+"""Configuration, unit storage and checkout validation shared by the web app and the RQ worker."""
+import os, sys, math, logging, json, threading, tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any, Dict, Optional, Union
+from dotenv import load_dotenv
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+import stripe
+
+from pledges.schema import CheckoutRequest
+
+if TYPE_CHECKING:
+    import redis
+    from rq import Queue
+
+try:
+    import fcntl
+except ImportError:  # Windows: only the single-process dev server runs there
+    fcntl = None  # type: ignore[assignment]
+
+# Load environment variables from the project root. The path is explicit
+# because find_dotenv() locates the caller through Python stack frames,
+# which the mypyc-compiled module does not have.
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env"))
+
+# Setup logging for production
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# === REQUIRED: Your live/test secret key must be set in .env as STRIPE_SECRET_KEY ===
+stripe_key = os.getenv("STRIPE_SECRET_KEY")
+if not stripe_key:
+    logger.error("STRIPE_SECRET_KEY not set in environment variables!")
+    raise ValueError("STRIPE_SECRET_KEY environment variable is required")
+
+stripe.api_key = stripe_key
+
+# One pooled HTTPS session to api.stripe.com, shared by every request in the
+# process, so checkouts reuse warm TLS connections instead of reconnecting.
+STRIPE_POOL_SIZE = int(os.getenv("STRIPE_POOL_SIZE", "50"))
+_stripe_session = requests.Session()
+_stripe_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_POOL_SIZE))
+stripe.default_http_client = stripe.RequestsClient(session=_stripe_session)
+
+# Default redirect URLs (can be overridden via env)
+BASE_URL = os.getenv("BASE_URL", "http://localhost:4242")
+SUCCESS_URL = os.getenv("SUCCESS_URL", f"{BASE_URL}/thank-you")
+CANCEL_URL  = os.getenv("CANCEL_URL",  f"{BASE_URL}/error")
+
+# Background queue for webhook side-effects. Without REDIS_URL, events are
+# processed inline in the request (handy for local development).
+# One capped connection pool per process serves both the dedupe keys and the queue.
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS: Optional["redis.Redis"] = None
+pledge_queue: Optional["Queue"] = None
+if REDIS_URL:
+    import redis
+    from rq import Queue
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+    REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))  # seconds to wait for a free connection
+    # Blocking pool: when all connections are busy, callers wait instead of
+    # failing with "Too many connections".
+    REDIS = redis.Redis(connection_pool=redis.BlockingConnectionPool.from_url(
+        REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT))
+    pledge_queue = Queue("pledges", connection=REDIS)
+EVENT_DEDUPE_TTL = 86400  # seconds to remember a delivered Stripe event id
+
+# Ramadan Pledges Configuration
+TOTAL_UNITS = 80
+UNIT_PRICE = 1000  # $1,000 per unit
+MIN_UNITS = 1
+MAX_UNITS = TOTAL_UNITS
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Unit tracking file
+UNITS_FILE = os.path.join(BASE_DIR, "units_data.json")
+INITIAL_UNITS = {
+    "aminah": 10,
+    "dreamers": 78,
+}
+
+ZERO_DECIMAL_CURRENCIES = frozenset({"bif","clp","djf","gnf","jpy","kmf","krw","mga","pyg","rwf","ugx","vnd","vuv","xaf","xof","xpf"})
+# Smallest chargeable unit_amount per currency (100 = $1.00 for two-decimal currencies)
+CURRENCY_MIN = {c: 1 for c in ZERO_DECIMAL_CURRENCIES}
+DEFAULT_CURRENCY_MIN = 100
+# Minor units per major unit (e.g. cents per dollar)
+CURRENCY_MULTIPLIER = {c: 1 for c in ZERO_DECIMAL_CURRENCIES}
+DEFAULT_CURRENCY_MULTIPLIER = 100
+MAX_UNIT_AMOUNT = 100000000
+RECURRING_INTERVAL = {"weekly": "week", "monthly": "month"}
+
+# Interned lowercase values the donor form sends, so each request maps onto
+# one shared string instead of keeping its own lowered copy.
+CURRENCY_CANON = {c: sys.intern(c) for c in {"usd", "gbp", "eur", "aed"} | ZERO_DECIMAL_CURRENCIES}
+FREQUENCY_CANON = {f: sys.intern(f) for f in ("once", "weekly", "monthly")}
+
+# Checkout strings that don't depend on the request
+UNIT_PRODUCT_DATA = {n: {"name": f"Ramadan Pledge - {n} Unit(s)"} for n in range(MIN_UNITS, MAX_UNITS + 1)}
+CUSTOM_PRODUCT_DATA = {"name": "Ramadan Pledge - Custom Donation"}
+# Session keys shared by every checkout; the handler adds the per-pledge ones.
+_SESSION_TEMPLATE = {"success_url": SUCCESS_URL, "cancel_url": CANCEL_URL}
+
+# Checkout error bodies, serialized once
+ERR_UNITS_RANGE = orjson.dumps({"error": f"Units must be between {MIN_UNITS} and {MAX_UNITS}."})
+ERR_CUSTOM_AMOUNT = orjson.dumps({"error": "Custom amount must be greater than 0."})
+ERR_WEEKLY_DURATION = orjson.dumps({"error": "Duration must be between 1 and 26 weeks."})
+ERR_MONTHLY_DURATION = orjson.dumps({"error": "Duration must be between 1 and 6 months."})
+ERR_AMOUNT_RANGE = orjson.dumps({"error": "Amount out of allowed range."})
+ERR_START_PAST = orjson.dumps({"error": "Start date cannot be in the past."})
+ERR_START_TOO_LATE = orjson.dumps({"error": "Start date cannot be later than 2026-04-20."})
+ERR_START_FORMAT = orjson.dumps({"error": "Invalid start_date format. Use YYYY-MM-DD."})
+MAX_START_DATE = datetime(2026, 4, 20, tzinfo=timezone.utc)
+
+# units_data.json is shared by every gunicorn worker and the RQ worker.
+# Read-modify-write cycles hold an exclusive flock on UNITS_LOCK_FILE (plus a
+# thread lock for greenlets/threads in the same process), and writes go to a
+# temp file that replaces the original, so readers never see a partial file.
+UNITS_LOCK_FILE = UNITS_FILE + ".lock"
+_units_thread_lock = threading.RLock()
+_units_lock_depth = 0
+_units_lock_fh = None
+
+class CheckoutError(Exception):
+    """Checkout input rejected by validation; `body` is the pre-serialized JSON error."""
+
+    def __init__(self, body: bytes) -> None:
+        super().__init__(body)
+        self.body = body
+
+@contextmanager
+def units_lock():
+    """Hold the cross-process lock on units_data.json; re-entrant within a thread."""
+    global _units_lock_depth, _units_lock_fh
+    with _units_thread_lock:
+        if _units_lock_depth == 0 and fcntl is not None:
+            _units_lock_fh = open(UNITS_LOCK_FILE, 'a')
+            fcntl.flock(_units_lock_fh, fcntl.LOCK_EX)
+        _units_lock_depth += 1
+        try:
+            yield
+        finally:
+            _units_lock_depth -= 1
+            if _units_lock_depth == 0 and _units_lock_fh is not None:
+                fcntl.flock(_units_lock_fh, fcntl.LOCK_UN)
+                _units_lock_fh.close()
+                _units_lock_fh = None
+
+def default_units_data():
+    return {
+        "remaining_units": INITIAL_UNITS.copy(),
+        "processed_sessions": []
+    }
+
+# Initialize units file if it doesn't exist
+def init_units():
+    if not os.path.exists(UNITS_FILE):
+        with units_lock():
+            if not os.path.exists(UNITS_FILE):
+                save_units_data(default_units_data())
+
+def _read_units_file():
+    try:
+        with open(UNITS_FILE, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        # Never fall back to defaults here: saving them would wipe every pledge.
+        logger.error("%s is not valid JSON; refusing to overwrite it", UNITS_FILE)
+        raise
+
+def load_units_data():
+    init_units()
+    data = _read_units_file()
+
+    # Migrate legacy flat structure into the current schema.
+    if "remaining_units" not in data:
+        with units_lock():
+            data = _read_units_file()
+            if "remaining_units" not in data:
+                data = {
+                    "remaining_units": {
+                        "aminah": data.get("aminah", INITIAL_UNITS["aminah"]),
+                        "dreamers": data.get("dreamers", INITIAL_UNITS["dreamers"]),
+                    },
+                    "processed_sessions": data.get("processed_sessions", [])
+                }
+                save_units_data(data)
+
+    return data
+
+def save_units_data(data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(UNITS_FILE), prefix=".units_data.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, UNITS_FILE)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def get_remaining_units(organization="aminah"):
+    """Get remaining units for a specific organization"""
+    data = load_units_data()
+    remaining_units = data.get("remaining_units", {})
+
+    if organization == "both":
+        return min(
+            remaining_units.get("aminah", INITIAL_UNITS["aminah"]),
+            remaining_units.get("dreamers", INITIAL_UNITS["dreamers"])
+        )
+
+    try:
+        return remaining_units.get(organization, INITIAL_UNITS[organization])
+    except Exception:
+        return INITIAL_UNITS.get(organization, 0)
+
+def _apply_decrement(data, organization, units_to_decrement):
+    """Decrement units for an organization in an already-loaded data dict."""
+    remaining_units = data.setdefault("remaining_units", INITIAL_UNITS.copy())
+
+    # Handle "both" organization - decrement from both aminah and dreamers
+    if organization == "both":
+        for org in ["aminah", "dreamers"]:
+            remaining = remaining_units.get(org, INITIAL_UNITS[org])
+            remaining = max(0, remaining - units_to_decrement)
+            remaining_units[org] = remaining
+    else:
+        remaining = remaining_units.get(organization, INITIAL_UNITS[organization])
+        remaining = max(0, remaining - units_to_decrement)
+        remaining_units[organization] = remaining
+
+def record_checkout(session_id, organization, units, pledge_record):
+    """Apply a completed checkout with a single load/save of units_data.json.
+
+    For unit pledges (`units` is not None) the units are decremented once per
+    session and the session is marked processed; the pledge record is stored
+    unless one already exists for the session.
+    """
+    with units_lock():
+        data = load_units_data()
+        changed = False
+
+        processed_sessions = data.setdefault("processed_sessions", [])
+        if units is not None and session_id and session_id not in processed_sessions:
+            if units > 0:
+                try:
+                    _apply_decrement(data, organization, units)
+                except KeyError:
+                    logger.warning("Unknown organization %r; units not decremented for %s", organization, session_id)
+            processed_sessions.append(session_id)
+            changed = True
+
+        pledges = data.setdefault("pledges", [])
+        if not any(p.get("session_id") == session_id for p in pledges):
+            pledges.append(pledge_record)
+            changed = True
+
+        if changed:
+            save_units_data(data)
+
+def canonical(table: Dict[str, str], raw: str) -> str:
+    """Return the interned lowercase form of `raw` from `table`, lowercasing only on a miss."""
+    value = table.get(raw)
+    if value is None:
+        lowered = raw.lower()
+        value = table.get(lowered, lowered)
+    return value
+
+def to_unit_amount(amount: Union[int, float], currency: str) -> int:
+    """Convert a major-unit amount to Stripe's unit_amount; `currency` must already be lowercase."""
+    multiplier = CURRENCY_MULTIPLIER.get(currency, DEFAULT_CURRENCY_MULTIPLIER)
+    if isinstance(amount, int):
+        # Unit pledges are whole amounts; stay in integer arithmetic.
+        if amount <= 0:
+            raise ValueError("Invalid amount")
+        return amount * multiplier
+    a = float(amount)
+    if not math.isfinite(a) or a <= 0:
+        raise ValueError("Invalid amount")
+    return int(round(a * multiplier))
+
+def build_checkout_params(data: CheckoutRequest) -> Dict[str, Any]:
+    """Validate a checkout request and build the stripe.checkout.Session.create() params.
+
+    Raises CheckoutError for input the donor needs to fix.
+    """
+    organization = (data.organization or "aminah").lower()
+    donation_type = (data.donation_type or "units").lower()
+    currency = canonical(CURRENCY_CANON, data.currency or "usd")
+    frequency = canonical(FREQUENCY_CANON, data.frequency or "monthly")  # once | weekly | monthly
+    duration = data.duration  # weeks or months
+    donor_name = data.donor_name
+    donor_email = data.donor_email
+    includes_zakat = data.includes_zakat
+    zakat_amount = data.zakat_amount
+    is_dedicated = data.is_dedicated
+    dedication_names = data.dedication_names
+    start_date_str = data.start_date.strip()  # YYYY-MM-DD, optional
+
+    # Determine amount based on donation type
+    units: Optional[int] = None
+    if donation_type == "units":
+        units = data.units if data.units is not None else 0
+        # Validate units
+        if units < MIN_UNITS or units > MAX_UNITS:
+            raise CheckoutError(ERR_UNITS_RANGE)
+        per_installment_amount: Union[int, float] = units * UNIT_PRICE
+        product_data = UNIT_PRODUCT_DATA[units]
+    else:  # custom
+        custom_amount = data.custom_amount or 0.0
+        if custom_amount <= 0:
+            raise CheckoutError(ERR_CUSTOM_AMOUNT)
+        per_installment_amount = custom_amount
+        product_data = CUSTOM_PRODUCT_DATA
+
+    # Validate duration
+    if frequency == "weekly" and (duration < 1 or duration > 26):
+        raise CheckoutError(ERR_WEEKLY_DURATION)
+    if frequency == "monthly" and (duration < 1 or duration > 6):
+        raise CheckoutError(ERR_MONTHLY_DURATION)
+
+    # For recurring with duration > 1, this becomes a payment plan (divide
+    # the pledge across the selected periods). A one-time pledge with a
+    # future start date will later be converted into a one-cycle
+    # subscription so Stripe can delay the single collection.
+    if frequency == "once":
+        total_amount = per_installment_amount * duration
+        per_period_amount = total_amount  # charge it all at once
+    elif duration > 1:
+        # Payment plan: charge per_installment_amount total, split across duration periods
+        total_amount = per_installment_amount
+        per_period_amount = total_amount / duration
+    else:
+        # True recurring: charge per_installment_amount every period
+        total_amount = per_installment_amount
+        per_period_amount = total_amount
+
+    unit_amount = to_unit_amount(per_period_amount, currency)
+
+    # Guardrails
+    if unit_amount < CURRENCY_MIN.get(currency, DEFAULT_CURRENCY_MIN) or unit_amount > MAX_UNIT_AMOUNT:
+        raise CheckoutError(ERR_AMOUNT_RANGE)
+
+    interval = RECURRING_INTERVAL.get(frequency)
+    is_recurring = interval is not None
+    price_data: Dict[str, Any] = {
+        "currency": currency,
+        "unit_amount": unit_amount,
+        "product_data": product_data
+    }
+    
+    if is_recurring:
+        price_data["recurring"] = {"interval": interval}
+
+    # Resolve start date for recurring and scheduled one-time pledges.
+    start_timestamp: Optional[int] = None
+    if start_date_str:
+        try:
+            start_dt = datetime.strptime(start_date_str, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            today_utc = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+            if start_dt < today_utc:
+                raise CheckoutError(ERR_START_PAST)
+            if start_dt > MAX_START_DATE:
+                raise CheckoutError(ERR_START_TOO_LATE)
+            if start_dt > today_utc:
+                start_timestamp = int(start_dt.timestamp())
+        except ValueError:
+            raise CheckoutError(ERR_START_FORMAT)
+
+    scheduled_one_time = False  # one-time payments are always charged immediately
+
+    # Build metadata
+    metadata: Dict[str, str] = {
+        "organization": organization,
+        "donation_type": donation_type,
+        "donor_name": donor_name,
+        "donor_email": donor_email,
+        "frequency": frequency,
+        "duration": str(duration),
+        "includes_zakat": str(includes_zakat),
+        "zakat_amount": str(zakat_amount),
+        "is_dedicated": str(is_dedicated),
+        "dedication_names": dedication_names
+    }
+    if start_timestamp:
+        metadata["start_date"] = start_date_str
+    
+    # Include units only if donation type is units
+    if donation_type == "units":
+        metadata["units"] = str(units)
+
+    # Build session parameters
+    session_params: Dict[str, Any] = {
+        **_SESSION_TEMPLATE,
+        "mode": "subscription" if is_recurring else "payment",
+        "line_items": [{"price_data": price_data, "quantity": 1}],
+        "metadata": metadata
+    }
+
+    # For recurring pledges, attach metadata to the subscription so the webhook
+    # can read duration and cancel once fully collected.
+    # If a future start date was chosen, set trial_end to delay the first charge.
+    if is_recurring:
+        subscription_data: Dict[str, Any] = {"metadata": metadata}
+        if start_timestamp:
+            subscription_data["trial_end"] = start_timestamp
+        session_params["subscription_data"] = subscription_data
+
+    # Add customer email if provided
+    if donor_email:
+        session_params["customer_email"] = donor_email
+
+    return session_params
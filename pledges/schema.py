@@ -0,0 +1,24 @@
+"""Request bodies decoded with msgspec.
+
+Kept out of the mypyc build of pledges/core.py: msgspec reads these class
+annotations at runtime, and compiled classes lose the Optional[...] types.
+"""
+from typing import Optional
+import msgspec
+
+class CheckoutRequest(msgspec.Struct):
+    """Body of POST /create-checkout-session; the donor form sends null for the unused amount field."""
+    organization: Optional[str] = None
+    donation_type: Optional[str] = None
+    currency: Optional[str] = None
+    frequency: Optional[str] = None
+    duration: int = 1
+    units: Optional[int] = 1
+    custom_amount: Optional[float] = None
+    donor_name: str = "Anonymous"
+    donor_email: str = ""
+    includes_zakat: bool = False
+    zakat_amount: float = 0.0
+    is_dedicated: bool = False
+    dedication_names: str = ""
+    start_date: str = ""
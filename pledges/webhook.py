@@ -0,0 +1,122 @@
+"""Stripe webhook event handling, run inline by the web app or as RQ jobs by the worker."""
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict
+import stripe
+
+from pledges.core import REDIS, EVENT_DEDUPE_TTL, record_checkout
+
+logger = logging.getLogger(__name__)
+
+def is_duplicate_event(event: Dict[str, Any]) -> bool:
+    """Record the Stripe event in Redis; returns True if it was already delivered."""
+    if REDIS is None:
+        return False
+    first_delivery = REDIS.set(f"event:{event['id']}", event.get("created", 0), nx=True, ex=EVENT_DEDUPE_TTL)
+    if first_delivery:
+        return False
+    deduped = REDIS.incr("event:deduped")
+    logger.info("Skipping duplicate Stripe event %s (%s deduplicated so far)", event['id'], deduped)
+    return True
+
+def forget_event(event: Dict[str, Any]) -> None:
+    """Drop the dedupe key for an event that could not be queued, so Stripe's retry is processed."""
+    if REDIS is not None:
+        REDIS.delete(f"event:{event['id']}")
+
+def _on_checkout_completed(session: Dict[str, Any]) -> None:
+    metadata = session.get("metadata", {})
+    session_id = session.get("id")
+    # One-time: session["payment_intent"]
+    # Recurring: session["subscription"]
+    org_value = metadata.get('organization', 'aminah')
+
+    units_value = None
+    if metadata.get('donation_type') == 'units':
+        units_value = int(metadata.get('units', '0') or '0')
+
+    # The summary pieces only feed the log line, so skip building them when INFO is off.
+    if logger.isEnabledFor(logging.INFO):
+        if org_value == 'both':
+            org_name = "Both Organizations (Aminah Islamic Center & Muslim Dreamers Learning Center)"
+        elif org_value == 'dreamers':
+            org_name = "Muslim Dreamers Learning Center"
+        else:
+            org_name = "Aminah Islamic Center"
+        donation_info = f"{metadata.get('units')} units" if metadata.get('units') else "custom donation"
+        zakat_info = ""
+        if metadata.get('includes_zakat') == 'True':
+            zakat_info = f" | Zakat Amount: ${metadata.get('zakat_amount')}"
+        dedication_info = ""
+        if metadata.get('is_dedicated') == 'True' and metadata.get('dedication_names'):
+            dedication_info = f" | Dedicated to: {metadata.get('dedication_names')}"
+        logger.info(
+            "Pledge completed: %s for %s to %s | Frequency: %s | Duration: %s%s%s | Session: %s",
+            metadata.get('donor_name'), donation_info, org_name, metadata.get('frequency'),
+            metadata.get('duration'), zakat_info, dedication_info, session['id'],
+        )
+    # Persist pledge locally for admin review
+    pledge_record = {
+        "session_id": session_id,
+        "donor_name": metadata.get("donor_name", "Anonymous"),
+        "donor_email": metadata.get("donor_email", ""),
+        "organization": org_value,
+        "donation_type": metadata.get("donation_type", ""),
+        "units": metadata.get("units", ""),
+        "frequency": metadata.get("frequency", ""),
+        "duration": metadata.get("duration", ""),
+        "includes_zakat": metadata.get("includes_zakat", "False") == "True",
+        "zakat_amount": metadata.get("zakat_amount", "0"),
+        "is_dedicated": metadata.get("is_dedicated", "False") == "True",
+        "dedication_names": metadata.get("dedication_names", ""),
+        "start_date": metadata.get("start_date", ""),
+        "recorded_at": datetime.now(timezone.utc).isoformat(),
+        "scheduled": bool(metadata.get("start_date")),
+    }
+    # Units, processed-session marker and pledge record land in one write, so
+    # the job only succeeds once the donor's record is on disk.
+    record_checkout(session_id, org_value, units_value, pledge_record)
+
+def _on_invoice_paid(invoice: Dict[str, Any]) -> None:
+    subscription_id = invoice.get("subscription")
+    logger.info("Recurring payment received: %s | Subscription: %s", invoice.get('id'), subscription_id)
+    # TODO: record recurring payment
+
+    # Cancel the subscription once the full pledge has been collected.
+    if subscription_id:
+        try:
+            subscription = stripe.Subscription.retrieve(subscription_id)
+            # Index and `in` work on StripeObject in every stripe-python
+            # release; newer ones no longer provide dict methods like .get().
+            sub_metadata = subscription.metadata
+            duration = int(sub_metadata["duration"]) if "duration" in sub_metadata else 0
+            frequency = sub_metadata["frequency"] if "frequency" in sub_metadata else ""
+
+            if duration > 0 and frequency in ("weekly", "monthly", "once"):
+                # Count all paid invoices for this subscription (max duration is 26).
+                # Exclude $0 trial-start invoices that Stripe generates when trial_end is used.
+                paid_invoices = stripe.Invoice.list(
+                    subscription=subscription_id,
+                    status="paid",
+                    limit=50
+                )
+                paid_count = sum(1 for inv in paid_invoices.data if (inv.amount_paid or 0) > 0)
+                logger.info("Subscription %s: %s/%s payment(s) collected", subscription_id, paid_count, duration)
+
+                if paid_count >= duration:
+                    stripe.Subscription.cancel(subscription_id)
+                    logger.info("Subscription %s cancelled — full pledge of %s payment(s) collected", subscription_id, duration)
+        except Exception as e:
+            logger.error("Error checking/cancelling subscription %s: %s", subscription_id, e)
+
+# Stripe event type -> handler for its data.object; other event types are ignored.
+WEBHOOK_HANDLERS = {
+    "checkout.session.completed": _on_checkout_completed,
+    "invoice.paid": _on_invoice_paid,
+}
+
+def process_pledge_event(event: Dict[str, Any]) -> None:
+    """Apply the side-effects of a verified Stripe event (runs in the RQ worker when REDIS_URL is set)."""
+    handler = WEBHOOK_HANDLERS.get(event["type"])
+    if handler:
+        handler(event["data"]["object"])
@@ -0,0 +1,13 @@
+"""Optional mypyc build of pledges/core.py: `python setup.py build_ext --inplace`.
+
+The compiled extension is imported in place of core.py; without it the
+pure-Python module is used.
+"""
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name="ramadan-pledges",
+    packages=["pledges"],
+    ext_modules=mypycify(["--ignore-missing-imports", "pledges/core.py"]),
+)
@@ -0,0 +1,9 @@
+"""WSGI entry point for production servers, e.g. `gunicorn wsgi:app` (see Procfile)."""
+# Patch the stdlib before Stripe's HTTP client is imported so its blocking
+# sockets yield to other greenlets while waiting on api.stripe.com.
+from gevent import monkey
+monkey.patch_all()
+
+from app import app  # noqa: E402
+
+__all__ = ["app"]